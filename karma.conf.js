@@ -23,12 +23,14 @@ module.exports = function (config) {
       suppressAll: true // removes the duplicated traces
     },
     coverageReporter: {
-      dir: require('path').join(__dirname, './coverage/ai-angular-smoke'),
+      // tools/ai_testgen.py redirects incremental (single-spec) runs away from the full report.
+      dir: process.env.AI_TESTGEN_COVERAGE_DIR || require('path').join(__dirname, './coverage/ai-angular-smoke'),
       subdir: '.',
       reporters: [
         { type: 'html' },
         { type: 'text-summary' },
-        { type: 'lcovonly' } 
+        { type: 'lcovonly' },
+        { type: 'json' }
       ],
       includeAllSources: true,
     },
@@ -4,15 +4,31 @@ from __future__ import annotations
 
 import argparse
 import ast
+import asyncio
+import collections
+import hashlib
+import http.client
+import json
+import mmap
+import operator
+import os
+import re
+import signal
 import subprocess
 import textwrap
+import threading
+import time
+import urllib.parse
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Callable, Deque, Dict, List, Optional, Set, Tuple
 
 
 @dataclass
 class CoverageEntry:
+    # One instance per covered file; slots keep large lcov reports cheap to hold.
+    __slots__ = ("path", "lh", "lf", "brh", "brf")
+
     path: str
     lh: int
     lf: int
@@ -28,11 +44,28 @@ class CoverageEntry:
         return (self.brh / self.brf * 100.0) if self.brf else 100.0
 
 
-def run(cmd: List[str]) -> None:
-    proc = subprocess.run(cmd, text=True, capture_output=True)
+# Lines of combined stdout/stderr kept for error reports; earlier output is discarded as it streams.
+RUN_OUTPUT_TAIL = 500
+
+
+def run(cmd: List[str], env: Optional[Dict[str, str]] = None) -> None:
+    tail: Deque[str] = collections.deque(maxlen=RUN_OUTPUT_TAIL)
+    with subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        encoding="utf-8",
+        errors="replace",
+        bufsize=1,
+        env=env,
+    ) as proc:
+        assert proc.stdout is not None
+        for line in proc.stdout:
+            tail.append(line)
     if proc.returncode != 0:
         raise RuntimeError(
-            f"Command failed: {' '.join(cmd)}\n\nSTDOUT:\n{proc.stdout}\n\nSTDERR:\n{proc.stderr}"
+            f"Command failed: {' '.join(cmd)}\n\nOUTPUT (last {RUN_OUTPUT_TAIL} lines):\n{''.join(tail)}"
         )
 
 
@@ -41,109 +74,586 @@ def run_ng_test_with_coverage() -> None:
     run(["npx", "ng", "test", "--watch=false", "--code-coverage"])
 
 
-def run_ng_test_quick() -> None:
-    # Faster validation run (still compiles and executes tests).
-    run(["npx", "ng", "test", "--watch=false"])
+# karma.conf.js writes coverage here instead of coverage/<projectName> when AI_TESTGEN_COVERAGE_DIR is set.
+DELTA_COVERAGE_DIR = Path("coverage/_delta")
+
+
+# Report directory of the long-lived Karma process started with --karma-daemon.
+KARMA_COVERAGE_DIR = Path("coverage/_karma")
+
+
+def source_signature() -> Tuple[Tuple[str, int], ...]:
+    # Everything under src/ except specs (the only files this tool writes).
+    return tuple(
+        sorted(
+            (p.as_posix(), p.stat().st_mtime_ns)
+            for p in Path("src").rglob("*")
+            if p.is_file() and not p.name.endswith(".spec.ts")
+        )
+    )
+
+
+# Incremental build info lets repeated type-checks reuse the resolved program between attempts.
+TSCONFIG_SPEC = "tsconfig.spec.json"
+TSBUILDINFO = "node_modules/.cache/ai-testgen/spec.tsbuildinfo"
+
+
+def run_ng_test_quick(spec_path: Path, coverage_dir: Optional[Path] = None) -> None:
+    # Type-check first: far cheaper than a Karma run and catches most generated-spec mistakes.
+    run(["npx", "tsc", "--noEmit", "-p", TSCONFIG_SPEC, "--incremental", "--tsBuildInfoFile", TSBUILDINFO])
+    # Then execute only the changed spec.
+    cmd = ["npx", "ng", "test", "--watch=false"]
+    include = f"--include={spec_path.as_posix()}"
+    if coverage_dir is None:
+        # Coverage is collected by the full run in main.
+        run(cmd + ["--code-coverage=false", "--source-map=false", include])
+        return
+    # Incremental mode: the same run also reports this spec's coverage, away from the full
+    # report (karma.conf.js honours AI_TESTGEN_COVERAGE_DIR).
+    (coverage_dir / "lcov.info").unlink(missing_ok=True)
+    run(cmd + ["--code-coverage", include], env={**os.environ, "AI_TESTGEN_COVERAGE_DIR": str(coverage_dir.resolve())})
+
+
+# Directories never worth descending into when looking for lcov.info.
+_LCOV_PRUNE = {"node_modules", ".git", DELTA_COVERAGE_DIR.name, KARMA_COVERAGE_DIR.name}
 
 
 def find_lcov() -> Path:
     # Angular writes coverage under coverage/<projectName>/lcov.info
-    matches = list(Path("coverage").glob("**/lcov.info"))
-    if not matches:
+    # Walk with scandir (file type comes from the directory entry, no per-file stat)
+    # and keep only the deepest match (coverage/<name>/lcov.info).
+    best: Optional[Path] = None
+    stack = ["coverage"]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in _LCOV_PRUNE:
+                        stack.append(entry.path)
+                elif entry.name == "lcov.info":
+                    cand = Path(entry.path)
+                    if best is None or len(cand.parts) > len(best.parts):
+                        best = cand
+    if best is None:
         raise FileNotFoundError("Could not find coverage/**/lcov.info. Did ng test --code-coverage run?")
-    # Prefer the deepest match (coverage/<name>/lcov.info)
-    matches.sort(key=lambda p: len(p.parts), reverse=True)
-    return matches[0]
+    return best
+
+
+# One compiled scanner over the raw bytes finds every record line we care about.
+_LCOV_RE = re.compile(rb"^(SF|LH|LF|BRH|BRF):([^\n]*)$|^end_of_record\r?$", re.M)
+_LCOV_SLOTS = {b"LH": 0, b"LF": 1, b"BRH": 2, b"BRF": 3}
+
 
+def is_app_source(path: str) -> bool:
+    # Only your source code
+    if not path.startswith("src/"):
+        return False
+    if path.endswith(".spec.ts"):
+        return False
+    # Skip boilerplate/config
+    if path.endswith(("/main.ts", "/test.ts")):
+        return False
+    return True
 
-def parse_lcov(lcov_path: Path) -> Dict[str, CoverageEntry]:
+
+def parse_lcov(lcov_path: Path, keep: Callable[[str], bool] = is_app_source) -> Dict[str, CoverageEntry]:
     # Minimal lcov parser for SF/LH/LF/BRH/BRF.
+    # Counters are collected per record and only materialized as CoverageEntry at end_of_record.
+    # Records whose path fails `keep` are skipped wholesale without scanning their lines.
     data: Dict[str, CoverageEntry] = {}
+    slots = _LCOV_SLOTS
+    search = _LCOV_RE.search
 
     sf: Optional[str] = None
-    lh: Optional[int] = None
-    lf: Optional[int] = None
-    brh: Optional[int] = None
-    brf: Optional[int] = None
-
-    for raw in lcov_path.read_text(encoding="utf-8").splitlines():
-        line = raw.strip()
-        if line.startswith("SF:"):
-            sf = line[3:].strip()
-            lh = lf = brh = brf = None
-        elif line.startswith("LH:"):
-            lh = int(line[3:].strip())
-        elif line.startswith("LF:"):
-            lf = int(line[3:].strip())
-        elif line.startswith("BRH:"):
-            brh = int(line[4:].strip())
-        elif line.startswith("BRF:"):
-            brf = int(line[4:].strip())
-        elif line == "end_of_record":
-            if sf is not None and lh is not None and lf is not None:
-                data[sf] = CoverageEntry(
-                    path=sf,
-                    lh=lh,
-                    lf=lf,
-                    brh=brh or 0,
-                    brf=brf or 0,
-                )
-            sf = None
+    rec: List[Optional[int]] = [None, None, None, None]
+
+    with lcov_path.open("rb") as fh:
+        if os.fstat(fh.fileno()).st_size == 0:
+            return data
+        # Scan the page-mapped file directly: no read copy, no decode of the whole text.
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            pos = 0
+            while True:
+                m = search(buf, pos)
+                if m is None:
+                    break
+                pos = m.end()
+                key = m.group(1)
+                if key is None:
+                    lh, lf, brh, brf = rec
+                    if sf is not None and lh is not None and lf is not None:
+                        data[sf] = CoverageEntry(sf, lh, lf, brh or 0, brf or 0)
+                    sf = None
+                elif key == b"SF":
+                    sf = m.group(2).strip().decode("utf-8")
+                    rec = [None, None, None, None]
+                    if not keep(sf):
+                        sf = None
+                        end = buf.find(b"\nend_of_record", pos)
+                        if end < 0:
+                            break
+                        pos = end + len(b"\nend_of_record")
+                else:
+                    rec[slots[key]] = int(m.group(2))
+            # A live match object pins the mapping and would make closing it fail.
+            m = None
 
     return data
 
 
+LCOV_CACHE_FILE = Path(".ai_testgen_cache.json")
+
+
+def _lcov_digest(lcov_path: Path) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with lcov_path.open("rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def parse_lcov_cached(lcov_path: Path) -> Dict[str, CoverageEntry]:
+    # Keyed on content rather than stat: every ng test rewrites lcov.info (new mtime), but CI
+    # reruns over an unchanged tree produce byte-identical reports.
+    digest = _lcov_digest(lcov_path)
+    cov: Optional[Dict[str, CoverageEntry]] = None
+    try:
+        cached = json.loads(LCOV_CACHE_FILE.read_text(encoding="utf-8"))
+        if cached.get("digest") == digest:
+            cov = {path: CoverageEntry(path, *counts) for path, counts in cached["entries"].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+
+    if cov is None:
+        cov = parse_lcov(lcov_path)
+        try:
+            LCOV_CACHE_FILE.write_text(
+                json.dumps(
+                    {
+                        "digest": digest,
+                        "entries": {e.path: [e.lh, e.lf, e.brh, e.brf] for e in cov.values()},
+                    }
+                ),
+                encoding="utf-8",
+            )
+        except OSError:
+            pass
+
+    return cov
+
+
+def parse_istanbul_json(report_path: Path, keep: Callable[[str], bool] = is_app_source) -> Dict[str, CoverageEntry]:
+    # Istanbul's coverage-final.json is already a per-file map; derive the same LH/LF/BRH/BRF
+    # numbers the lcov reporter would (a line's count is the max over statements starting on it).
+    data: Dict[str, CoverageEntry] = {}
+    for key, fc in json.loads(report_path.read_bytes()).items():
+        path = Path(os.path.relpath(fc.get("path") or key)).as_posix()
+        if not keep(path):
+            continue
+        stmt_map = fc["statementMap"]
+        lines: Dict[int, int] = {}
+        for sid, count in fc["s"].items():
+            line = stmt_map[sid]["start"]["line"]
+            if lines.get(line, -1) < count:
+                lines[line] = count
+        branches = [n for counts in fc["b"].values() for n in counts]
+        data[path] = CoverageEntry(
+            path=path,
+            lh=sum(1 for n in lines.values() if n > 0),
+            lf=len(lines),
+            brh=sum(1 for n in branches if n > 0),
+            brf=len(branches),
+        )
+    return data
+
+
+class KarmaDaemon:
+    """`ng test --watch` kept alive across iterations so the Angular build is only paid once.
+
+    Writing a spec triggers a rebuild and rerun; coverage is read from the Istanbul JSON report
+    once it has been rewritten after the last spec write and the process has gone quiet for
+    `settle` seconds (a rerun already in flight would otherwise be mistaken for the fresh one).
+
+    The watcher is not paused while candidate specs are validated, so every candidate written
+    and reverted by generate_or_update_spec also triggers a daemon rebuild and test run that
+    competes with the validation run for CPU.
+    """
+
+    def __init__(self, out_dir: Path = KARMA_COVERAGE_DIR, settle: float = 5.0, timeout: float = 900.0) -> None:
+        self.out_dir = out_dir
+        self.report = out_dir / "coverage-final.json"
+        self.log_path = out_dir / "karma.log"
+        self.settle = settle
+        self.timeout = timeout
+        self.proc: Optional[subprocess.Popen] = None
+
+    def start(self) -> None:
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        self.report.unlink(missing_ok=True)
+        with self.log_path.open("wb") as log:
+            self.proc = subprocess.Popen(
+                ["npx", "ng", "test", "--watch=true", "--code-coverage"],
+                stdout=log,
+                stderr=subprocess.STDOUT,
+                env={**os.environ, "AI_TESTGEN_COVERAGE_DIR": str(self.out_dir.resolve())},
+                start_new_session=True,
+            )
+
+    def stop(self) -> None:
+        if self.proc is None or self.proc.poll() is not None:
+            return
+        # npx/ng/karma/Chrome form a process tree; signal the whole session.
+        if hasattr(os, "killpg"):
+            os.killpg(self.proc.pid, signal.SIGTERM)
+        else:
+            self.proc.terminate()
+        try:
+            self.proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            if hasattr(os, "killpg"):
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+            self.proc.wait()
+
+    def _mtime_ns(self, path: Path) -> int:
+        try:
+            return path.stat().st_mtime_ns
+        except OSError:
+            return 0
+
+    def coverage(self, not_before: int = 0) -> Dict[str, CoverageEntry]:
+        # `not_before` is when the specs were last written (ns, wall clock); the write itself
+        # already queued the rebuild, so only reports produced after it count.
+        if self.proc is None:
+            self.start()
+        assert self.proc is not None
+
+        deadline = time.monotonic() + self.timeout
+        while True:
+            if self.proc.poll() is not None:
+                tail = self.log_path.read_text(encoding="utf-8", errors="replace")[-20000:]
+                raise RuntimeError(f"Karma daemon exited with code {self.proc.returncode}:\n{tail}")
+            report_ns = self._mtime_ns(self.report)
+            if report_ns > not_before:
+                quiet_ns = max(report_ns, self._mtime_ns(self.log_path))
+                if time.time_ns() - quiet_ns >= self.settle * 1e9:
+                    return parse_istanbul_json(self.report)
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No fresh coverage from the Karma daemon within {self.timeout:.0f}s")
+            time.sleep(0.5)
+
+
 def undercovered_files(cov: Dict[str, CoverageEntry], min_pct: float) -> List[CoverageEntry]:
-    out: List[CoverageEntry] = []
+    # Each percentage is read once per entry and the (line_pct, branch_pct) sort key is
+    # built once, alongside the entry, instead of re-deriving both inside the sort.
+    scored: List[Tuple[Tuple[float, float], CoverageEntry]] = []
     for entry in cov.values():
-        # Only your source code
-        if not entry.path.startswith("src/"):
+        if not is_app_source(entry.path):
             continue
-        if entry.path.endswith(".spec.ts"):
-            continue
-        # Skip boilerplate/config
-        if entry.path.endswith(("/main.ts", "/test.ts")):
-            continue
-        if entry.line_pct < min_pct or entry.branch_pct < min_pct:
-            out.append(entry)
+        line_pct = entry.line_pct
+        branch_pct = entry.branch_pct
+        if line_pct < min_pct or branch_pct < min_pct:
+            scored.append(((line_pct, branch_pct), entry))
 
     # Lowest coverage first
-    out.sort(key=lambda e: (e.line_pct, e.branch_pct))
+    scored.sort(key=operator.itemgetter(0))
+    return [entry for _, entry in scored]
+
+
+# Single-pass scanner over a TypeScript source. Comments and string/template literals are
+# matched (and ignored) first, so declarations mentioned inside them are not picked up.
+_TS_SCAN_RE = re.compile(
+    r"""
+      //[^\n]*
+    | /\*[\s\S]*?\*/
+    | '(?:\\.|[^'\\\n])*'
+    | "(?:\\.|[^"\\\n])*"
+    | `(?:\\.|[^`\\])*`
+    | (?P<component>@Component\b)
+    | (?P<imports>\bimports:)
+    | \bexport\s+class\s+(?P<cls>\w+)
+    | ^\s*(?:export\s+)?(?:type\s+(?P<alias>\w+)\s*=|(?:interface|enum)\s+(?P<decl>\w+)\s*\{)
+    """,
+    re.M | re.X,
+)
+
+
+@dataclass
+class SourceScan:
+    class_name: Optional[str]
+    is_standalone: bool
+    local_type_names: Set[str]
+
+
+def scan_ts_source(src: str) -> SourceScan:
+    class_name: Optional[str] = None
+    seen_component = False
+    is_standalone = False
+    local_type_names: Set[str] = set()
+
+    for m in _TS_SCAN_RE.finditer(src):
+        kind = m.lastgroup
+        if kind is None:
+            continue
+        if kind == "cls":
+            if class_name is None:
+                class_name = m.group("cls")
+        elif kind == "component":
+            seen_component = True
+        elif kind == "imports":
+            # Heuristic: standalone components typically have `imports:` in @Component metadata.
+            is_standalone = is_standalone or seen_component
+        else:
+            local_type_names.add(m.group(kind))
+
+    return SourceScan(class_name=class_name, is_standalone=is_standalone, local_type_names=local_type_names)
+
+
+# Patterns used by generate_or_update_spec, compiled once.
+_DECL_RE = re.compile(r"\bdeclarations\b\s*:")
+_TESTBED_IMPORTS_RE = re.compile(r"configureTestingModule\(\s*\{[\s\S]*?imports\s*:\s*\[([^\]]*)\]")
+
+
+def local_type_ref_pattern(type_names: Set[str]) -> Optional[re.Pattern]:
+    # One alternation covering `: Type`, `as Type` and `<Type>` for every name; longest names first
+    # so a name never shadows a longer one it prefixes.
+    if not type_names:
+        return None
+    alts = "|".join(map(re.escape, sorted(type_names, key=len, reverse=True)))
+    return re.compile(rf":\s*(?:{alts})\b|\s+as\s+(?:{alts})\b|<\s*(?:{alts})\s*>")
+
+
+LLM_CACHE_DIR = Path(".ai_testgen_cache")
+
+
+class LlmCache:
+    """Model responses keyed by the exact prompt, plus outputs that failed validation this run.
+
+    Responses live on disk, so CI reruns over unchanged sources and specs read them instead of
+    calling the model again. Validation failures depend on the rest of the tree and on the test
+    runner, so they are only remembered for the current run, per (source, output).
+    """
+
+    def __init__(self, root: Path = LLM_CACHE_DIR) -> None:
+        self.responses = root / "llm"
+        self._run_rejects: Dict[str, str] = {}
+
+    @staticmethod
+    def _digest(*parts: str) -> str:
+        h = hashlib.blake2b(digest_size=20)
+        for part in parts:
+            data = part.encode("utf-8")
+            h.update(len(data).to_bytes(8, "little"))
+            h.update(data)
+        return h.hexdigest()
+
+    def key(self, model: str, prompt: str) -> str:
+        # The prompt already embeds every input: rules, coverage numbers, source, spec and error.
+        return self._digest(model, prompt)
+
+    def get(self, key: str) -> Optional[str]:
+        try:
+            return (self.responses / f"{key}.ts").read_text(encoding="utf-8")
+        except OSError:
+            return None
+
+    def put(self, key: str, response: str) -> None:
+        self.responses.mkdir(parents=True, exist_ok=True)
+        (self.responses / f"{key}.ts").write_text(response, encoding="utf-8")
+
+    def evict(self, key: str) -> None:
+        (self.responses / f"{key}.ts").unlink(missing_ok=True)
+
+    def known_reject(self, src: str, out: str) -> Optional[str]:
+        return self._run_rejects.get(self._digest(src, out))
+
+    def reject(self, key: str, src: str, out: str, reason: str) -> None:
+        # Forget the response so the same prompt is sent to the model again next time,
+        # and remember why this exact output failed so it is not validated twice.
+        self.evict(key)
+        self._run_rejects[self._digest(src, out)] = reason
+
+
+def _ollama_address() -> Tuple[str, int]:
+    # Same convention as the ollama CLI: OLLAMA_HOST=[http://]host[:port].
+    host = os.environ.get("OLLAMA_HOST", "127.0.0.1:11434")
+    parts = urllib.parse.urlsplit(host if "://" in host else f"http://{host}")
+    return parts.hostname or "127.0.0.1", parts.port or 11434
+
+
+# One keep-alive connection per worker thread; run_ollama hops to threads via asyncio.to_thread.
+_ollama_conns = threading.local()
+
+
+def _ollama_post(path: str, body: str) -> Tuple[int, bytes]:
+    conn = getattr(_ollama_conns, "conn", None)
+    if conn is None:
+        conn = _ollama_conns.conn = http.client.HTTPConnection(*_ollama_address(), timeout=None)
+    try:
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json"})
+        resp = conn.getresponse()
+        return resp.status, resp.read()
+    except (http.client.HTTPException, OSError):
+        conn.close()
+        _ollama_conns.conn = None
+        raise
+
+
+def _ollama_generate(model: str, prompt: str) -> str:
+    body = json.dumps({"model": model, "prompt": prompt, "stream": False})
+    try:
+        status, payload = _ollama_post("/api/generate", body)
+    except (http.client.HTTPException, OSError):
+        # The server may have dropped an idle keep-alive connection; reconnect once.
+        status, payload = _ollama_post("/api/generate", body)
+    if status != 200:
+        raise RuntimeError(f"Ollama failed:\n{payload.decode('utf-8', errors='replace')}")
+    return json.loads(payload)["response"].strip()
+
+
+async def run_ollama(model: str, prompt: str) -> str:
+    return await asyncio.to_thread(_ollama_generate, model, prompt)
+
+
+def normalize_spec_output(out: str, local_type_ref_re: Optional[re.Pattern]) -> str:
+    # If the model returned the entire file as a single quoted string, unquote it.
+    if out and out[0] in ("'", '"') and out[-1] == out[0]:
+        try:
+            unquoted = ast.literal_eval(out)
+            if isinstance(unquoted, str):
+                candidate = unquoted.strip()
+                if "describe(" in candidate or "import " in candidate:
+                    out = candidate
+        except Exception:
+            pass
+
+    # Normalize indentation and strip BOM/zero-width chars.
+    out = out.lstrip("\ufeff\u200b\u200c\u200d")
+    out = textwrap.dedent(out).rstrip() + "\n"
+
+    # Auto-fix common mistake: using `declarations` instead of `imports`.
+    # This avoids the frequent standalone-component error in Angular 15+.
+    if "configureTestingModule" in out and "declarations" in out:
+        out = _DECL_RE.sub("imports:", out)
+
+    # Auto-strip references to app-local type names (often not importable in spec).
+    # This keeps the generated spec compiling even if the model adds annotations/casts.
+    # Strips annotations (`const x: Type`, `): Type`), casts (`as Type`) and generics (`<Type>`).
+    if local_type_ref_re is not None:
+        out = local_type_ref_re.sub("", out)
+
     return out
 
 
-def run_ollama(model: str, prompt: str) -> str:
-    proc = subprocess.run(
-        ["ollama", "run", model],
-        input=prompt,
-        text=True,
-        capture_output=True,
-    )
-    if proc.returncode != 0:
-        raise RuntimeError(f"Ollama failed:\n{proc.stderr}")
-    return proc.stdout.strip()
+_REPAIR_INSTRUCTIONS = """
+
+REPAIR INSTRUCTIONS:
+The previous output caused the Angular compiler/test run to fail.
+Fix the spec so it compiles and tests run.
+Remove any invented typed objects and instead use existing component instance data (e.g., component.someArray[0]) and clone via spread.
+Avoid index signatures and avoid referencing non-exported app types.
+
+ERROR:
+"""
+
+
+# Fixed strings that disqualify a candidate anywhere in the text, found in one scan.
+_FORBIDDEN_RE = re.compile(
+    r"(?P<markdown>```|(?i:markdown))"
+    # Patterns that commonly cause strict TS failures (TS2345/TS4111).
+    r"|(?P<loose>\{ \[key: string\]: any \}|\[key: string\]: any|Record<string, any>|as Record)"
+    r"|(?P<declarations>declarations)"
+)
+_FORBIDDEN_ERRORS = {
+    "markdown": "Output contained markdown/commentary.",
+    "loose": "Output used forbidden loose typing; derive data from the component instance and clone via spread instead.",
+    "declarations": "Output still used TestBed declarations. Use imports only (especially for standalone components).",
+}
+
+
+def guardrail_error(out: str, class_name: str, is_standalone: bool) -> Optional[str]:
+    # Cheap structural checks on a normalized candidate spec; returns why it was rejected.
+    # Ordered cheapest first: prefix checks, then substring presence, then full-text scans.
+    first = out.lstrip()
+    if not first:
+        return "Output was empty."
+
+    # Must not begin with a quote.
+    if first.startswith(("'", '"')):
+        return "Output started with a quote (string literal)."
+
+    # Reject commentary before the code.
+    if first[:4].lower() == "here":
+        return _FORBIDDEN_ERRORS["markdown"]
+
+    # Must start like a real TS file.
+    if not first.startswith("import "):
+        return "First non-empty line was not an import statement."
 
+    # Must look like an Angular Jasmine spec.
+    if not all(token in out for token in ("describe(", "it(", "expect(")):
+        return "Output missing describe/it/expect."
 
+    # Strong signal that TestBed is used.
+    if "TestBed" not in out:
+        return "Output missing TestBed."
 
+    # Markdown fences, loose typing and leftover TestBed declarations.
+    hit = _FORBIDDEN_RE.search(out)
+    if hit is not None:
+        return _FORBIDDEN_ERRORS[hit.lastgroup or "markdown"]
 
-def generate_or_update_spec(model: str, src_path: Path, spec_path: Path, min_pct: float, line_pct: float, branch_pct: float) -> None:
+    # (Removed: validation block for referencing local types, now auto-stripped before these checks.)
+
+    if is_standalone:
+        # If the target is standalone, ensure it is included in TestBed imports array.
+        m_imports = _TESTBED_IMPORTS_RE.search(out)
+        imports_blob = m_imports.group(1) if m_imports else ""
+        if class_name not in imports_blob:
+            return (
+                f"Standalone target component '{class_name}' must be in TestBed imports array. "
+                "Use: imports: [TargetComponent]"
+            )
+
+        if "createComponent(" in out and class_name not in out.split("createComponent(", 1)[1]:
+            return f"Spec attempted to create a different component than the target '{class_name}'."
+
+    return None
+
+
+async def generate_or_update_spec(
+    model: str,
+    src_path: Path,
+    spec_path: Path,
+    min_pct: float,
+    line_pct: float,
+    branch_pct: float,
+    llm_slots: asyncio.Semaphore,
+    validate_lock: asyncio.Lock,
+    llm_cache: Optional[LlmCache] = None,
+    coverage_dir: Optional[Path] = None,
+) -> Optional[Dict[str, CoverageEntry]]:
+    # With `coverage_dir`, returns the coverage of the accepted spec's own validation run
+    # (None if that report could not be read).
     src = src_path.read_text(encoding="utf-8")
     spec = spec_path.read_text(encoding="utf-8") if spec_path.exists() else ""
 
-    import re
+    scan = scan_ts_source(src)
 
     # Best-effort extraction of the exported class name.
-    m = re.search(r"export\s+class\s+(\w+)", src)
-    class_name = m.group(1) if m else src_path.stem
+    class_name = scan.class_name or src_path.stem
 
-    # Heuristic: standalone components typically have `imports:` in @Component metadata.
-    is_standalone = "@Component" in src and "imports:" in src
+    is_standalone = scan.is_standalone
 
-    # Collect app-local type names declared in the source file.
+    # App-local type names declared in the source file.
     # These names are often not importable from the spec file, so tests should avoid referencing them.
-    local_type_names = set(re.findall(r"^\s*(?:export\s+)?type\s+(\w+)\s*=", src, flags=re.M))
-    local_type_names |= set(re.findall(r"^\s*(?:export\s+)?interface\s+(\w+)\s*\{", src, flags=re.M))
-    local_type_names |= set(re.findall(r"^\s*(?:export\s+)?enum\s+(\w+)\s*\{", src, flags=re.M))
+    local_type_names = scan.local_type_names
+    local_type_ref_re = local_type_ref_pattern(local_type_names - {class_name})
 
     forbidden_type_names_line = "None" if not local_type_names else ", ".join(sorted(local_type_names))
 
@@ -164,7 +674,11 @@ def generate_or_update_spec(model: str, src_path: Path, spec_path: Path, min_pct
         "When you need test data, derive it from the component instance (e.g., const x = component.someArray[0];) and clone with spread ({...x, field: ...})."
     )
 
-    base_prompt = f"""
+    # The source and spec can be tens of KB; assemble the prompt from parts in one join
+    # rather than growing one large f-string.
+    base_prompt = "".join(
+        (
+            f"""
 SYSTEM:
 {system_rules}
 
@@ -176,192 +690,268 @@ Standalone component: {str(is_standalone)}
 Forbidden local type names (do not write these identifiers anywhere in the spec): {forbidden_type_names_line}
 
 SOURCE FILE ({src_path.as_posix()}):
-{src}
+""",
+            src,
+            f"""
 
 CURRENT SPEC ({spec_path.as_posix()}):
-{spec}
+""",
+            spec,
+            f"""
 
 TASK:
 Return the COMPLETE updated spec file for {spec_path.name}.
-"""
+""",
+        )
+    )
 
     original_spec = spec
 
     last_error: Optional[str] = None
 
     for attempt in range(1, 4):
-        prompt = base_prompt
         if last_error:
-            prompt += f"""
-
-REPAIR INSTRUCTIONS:
-The previous output caused the Angular compiler/test run to fail.
-Fix the spec so it compiles and tests run.
-Remove any invented typed objects and instead use existing component instance data (e.g., component.someArray[0]) and clone via spread.
-Avoid index signatures and avoid referencing non-exported app types.
-
-ERROR:
-{last_error}
-"""
-        out = run_ollama(model, prompt).strip()
-
-        # If the model returned the entire file as a single quoted string, unquote it.
-        if out and out[0] in ("'", '"') and out[-1] == out[0]:
-            try:
-                unquoted = ast.literal_eval(out)
-                if isinstance(unquoted, str):
-                    candidate = unquoted.strip()
-                    if "describe(" in candidate or "import " in candidate:
-                        out = candidate
-            except Exception:
-                pass
-
-        # Normalize indentation and strip BOM/zero-width chars.
-        out = out.lstrip("\ufeff\u200b\u200c\u200d")
-        out = textwrap.dedent(out).rstrip() + "\n"
-
-        # Auto-fix common mistake: using `declarations` instead of `imports`.
-        # This avoids the frequent standalone-component error in Angular 15+.
-        if "configureTestingModule" in out and "declarations" in out:
-            out = re.sub(r"\bdeclarations\b\s*:", "imports:", out)
-
-        # Auto-strip references to app-local type names (often not importable in spec).
-        # This keeps the generated spec compiling even if the model adds annotations/casts.
-        for tname in sorted(local_type_names, key=len, reverse=True):
-            if tname == class_name:
-                continue
-            # Remove type annotations like `const x: Type = ...` or function returns `): Type`.
-            out = re.sub(rf":\s*{re.escape(tname)}\b", "", out)
-            # Remove casts like `as Type`.
-            out = re.sub(rf"\s+as\s+{re.escape(tname)}\b", "", out)
-            # Remove generic usages like `<Type>`.
-            out = re.sub(rf"<\s*{re.escape(tname)}\s*>", "", out)
-
-        # Reject markdown fences or commentary.
-        if "```" in out or out.lstrip().lower().startswith("here") or "markdown" in out.lower():
-            last_error = "Output contained markdown/commentary."
-            continue
-
-        # Must look like an Angular Jasmine spec.
-        if "describe(" not in out or "it(" not in out or "expect(" not in out:
-            last_error = "Output missing describe/it/expect."
-            continue
-
-        # Strong signal that TestBed is used.
-        if "TestBed" not in out:
-            last_error = "Output missing TestBed."
-            continue
-
-        # Reject patterns that commonly cause strict TS failures (TS2345/TS4111).
-        bad_patterns = [
-            "{ [key: string]: any }",
-            "[key: string]: any",
-            "Record<string, any>",
-            "as Record",
-        ]
-        if any(pat in out for pat in bad_patterns):
-            last_error = "Output used forbidden loose typing; derive data from the component instance and clone via spread instead."
-            continue
-
-        # (Removed: validation block for referencing local types, now auto-stripped above.)
-
-        # Must not begin with a quote.
-        if out.lstrip().startswith(("'", '"')):
-            last_error = "Output started with a quote (string literal)."
-            continue
-
-        # Must start like a real TS file.
-        first = out.lstrip()
-        if not first.startswith("import "):
-            last_error = "First non-empty line was not an import statement."
-            continue
-
-        # Reject any remaining TestBed/module declarations usage.
-        if "declarations" in out:
-            last_error = "Output still used TestBed declarations. Use imports only (especially for standalone components)."
-            continue
-
-        # If the target is standalone, ensure it is included in TestBed imports array.
-        if is_standalone:
-            m_imports = re.search(r"configureTestingModule\(\s*\{[\s\S]*?imports\s*:\s*\[([^\]]*)\]", out)
-            imports_blob = m_imports.group(1) if m_imports else ""
-            if class_name not in imports_blob:
-                last_error = (
-                    f"Standalone target component '{class_name}' must be in TestBed imports array. "
-                    "Use: imports: [TargetComponent]"
-                )
-                continue
-
-        if is_standalone and ("createComponent(" in out) and (class_name not in out.split("createComponent(", 1)[1]):
-            last_error = f"Spec attempted to create a different component than the target '{class_name}'."
-            continue
-
-        # Write candidate spec, validate compilation by running tests quickly.
-        spec_path.parent.mkdir(parents=True, exist_ok=True)
-        spec_path.write_text(out, encoding="utf-8")
-
-        try:
-            run_ng_test_quick()
-            return
-        except Exception as e:
-            # Capture the error, revert the spec, and retry with error context.
-            last_error = str(e)
-            spec_path.write_text(original_spec, encoding="utf-8")
+            prompt = "".join((base_prompt, _REPAIR_INSTRUCTIONS, last_error, "\n"))
+        else:
+            prompt = base_prompt
+        out: Optional[str] = None
+        cache_key = llm_cache.key(model, prompt) if llm_cache is not None else ""
+        cached = llm_cache.get(cache_key) if llm_cache is not None else None
+        if cached is not None:
+            out = normalize_spec_output(cached, local_type_ref_re)
+            if out == spec and llm_cache is not None:
+                # A response that reproduces the current spec would be replayed on every
+                # iteration (and every CI rerun) without the model ever being asked again.
+                llm_cache.evict(cache_key)
+                out = None
+        if out is None:
+            # Generations for several targets may be in flight at once (see --parallel).
+            async with llm_slots:
+                response = (await run_ollama(model, prompt)).strip()
+            if llm_cache is not None:
+                llm_cache.put(cache_key, response)
+            out = normalize_spec_output(response, local_type_ref_re)
+
+        reason = guardrail_error(out, class_name, is_standalone)
+        if reason is not None:
+            # Cheap to recompute, and it depends on the target as well as the output.
+            last_error = reason
+            if llm_cache is not None:
+                llm_cache.evict(cache_key)
             continue
+        if llm_cache is not None:
+            # This exact output already failed validation earlier in this run.
+            reason = llm_cache.known_reject(src, out)
+
+        if reason is None:
+            # Validation runs the shared test suite, so only one candidate spec may be on disk
+            # at a time; otherwise a broken spec for one target would fail another's check.
+            async with validate_lock:
+                # Write candidate spec, validate compilation by running tests quickly.
+                spec_path.parent.mkdir(parents=True, exist_ok=True)
+                spec_path.write_text(out, encoding="utf-8")
+
+                try:
+                    await asyncio.to_thread(run_ng_test_quick, spec_path, coverage_dir)
+                except Exception as e:
+                    # Capture the error, revert the spec, and retry with error context.
+                    reason = str(e)
+                    spec_path.write_text(original_spec, encoding="utf-8")
+                else:
+                    if coverage_dir is None:
+                        return None
+                    # Parsed under the lock: the next validation run overwrites the report.
+                    try:
+                        return parse_lcov(coverage_dir / "lcov.info")
+                    except (OSError, ValueError):
+                        return None
+
+        last_error = reason
+        if llm_cache is not None:
+            llm_cache.reject(cache_key, src, out, reason)
 
     raise RuntimeError(f"Failed to generate a compiling spec after 3 attempts. Last error:\n{last_error}")
 
 
-def main() -> int:
+async def main() -> int:
     ap = argparse.ArgumentParser(description="Iteratively generate/update Angular unit tests to meet per-file coverage.")
     ap.add_argument("--min", type=float, default=90.0, help="Minimum required percentage for lines and branches.")
-    ap.add_argument("--max-iters", type=int, default=10, help="Maximum iterations (one file fixed per iteration).")
+    ap.add_argument("--max-iters", type=int, default=10, help="Maximum iterations (up to --parallel files fixed per iteration).")
     ap.add_argument("--model", default="qwen2.5-coder:7b-instruct", help="Ollama model tag.")
+    ap.add_argument(
+        "--parallel",
+        type=int,
+        default=int(os.environ.get("OLLAMA_NUM_PARALLEL", "1")),
+        help="Number of under-covered files to generate specs for concurrently (defaults to $OLLAMA_NUM_PARALLEL or 1).",
+    )
+    ap.add_argument(
+        "--incremental",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help="Between full coverage runs, refresh coverage from the validation runs of the updated specs.",
+    )
+    ap.add_argument(
+        "--full-every",
+        type=int,
+        default=5,
+        help="With --incremental, force a full coverage run at least every N iterations.",
+    )
+    ap.add_argument(
+        "--karma-daemon",
+        action="store_true",
+        help="Keep one `ng test --watch` running and read coverage from its Istanbul JSON report instead of rerunning ng test.",
+    )
+    ap.add_argument(
+        "--llm-cache",
+        action=argparse.BooleanOptionalAction,
+        default=True,
+        help=f"Reuse model responses stored under {LLM_CACHE_DIR}/.",
+    )
     args = ap.parse_args()
 
+    daemon = KarmaDaemon() if args.karma_daemon else None
+    try:
+        return await _main(args, daemon)
+    finally:
+        if daemon is not None:
+            daemon.stop()
+
+
+async def _main(args: argparse.Namespace, daemon: Optional[KarmaDaemon]) -> int:
     min_pct = args.min
+    parallel = max(1, args.parallel)
+    llm_slots = asyncio.Semaphore(parallel)
+    validate_lock = asyncio.Lock()
+    llm_cache = LlmCache() if args.llm_cache else None
+
+    # When the specs written by the previous iteration last changed on disk.
+    last_write_ns = 0
+    # Only the first report of a process can match the digest cache (a CI rerun over an
+    # unchanged tree); later ones follow a spec write and would only pay for hashing and a write.
+    lcov_cache_eligible = True
+
+    def full_coverage() -> Dict[str, CoverageEntry]:
+        nonlocal lcov_cache_eligible
+        if daemon is not None:
+            try:
+                return daemon.coverage(last_write_ns)
+            except (TimeoutError, RuntimeError, ValueError, KeyError) as e:
+                # ValueError/KeyError: a truncated or malformed coverage-final.json.
+                detail = str(e).partition("\n")[0] or type(e).__name__
+                print(f"Karma daemon gave no fresh coverage, falling back to a full run: {detail}")
+        run_ng_test_with_coverage()
+        lcov = find_lcov()
+        if lcov_cache_eligible:
+            lcov_cache_eligible = False
+            return parse_lcov_cached(lcov)
+        return parse_lcov(lcov)
+
+    # Coverage map carried across iterations; None forces a full run.
+    cov: Optional[Dict[str, CoverageEntry]] = None
+    # False once a spec has been written since `cov` last came from a full run.
+    cov_is_full_and_current = False
+    # Sources whose record was replaced from a delta run since the last full run.
+    from_delta: Set[str] = set()
+    src_sig = source_signature()
+    since_full = 0
+    # With the daemon a full refresh is cheap, so there is nothing to gain from delta runs.
+    incremental = args.incremental and daemon is None
 
     for i in range(1, args.max_iters + 1):
         print(f"\n=== Iteration {i}/{args.max_iters} ===")
-        run_ng_test_with_coverage()
+        sig = source_signature()
+        if cov is None or not incremental or since_full >= args.full_every or sig != src_sig:
+            cov = await asyncio.to_thread(full_coverage)
+            cov_is_full_and_current = True
+            from_delta.clear()
+            src_sig = sig
+            since_full = 0
+        since_full += 1
 
-        lcov = find_lcov()
-        cov = parse_lcov(lcov)
         targets = undercovered_files(cov, min_pct)
 
+        # Delta records only count the updated specs, so they are a lower bound: confirm with a
+        # full run before declaring success or regenerating a spec that was just written.
+        if not cov_is_full_and_current and (not targets or any(t.path in from_delta for t in targets[:parallel])):
+            cov = await asyncio.to_thread(full_coverage)
+            cov_is_full_and_current = True
+            from_delta.clear()
+            src_sig = sig
+            since_full = 1
+            targets = undercovered_files(cov, min_pct)
+
         if not targets:
             print(f"OK: all files meet >= {min_pct:.0f}% lines and branches")
             return 0
 
-        t = targets[0]
-        src_path = Path(t.path)
-        spec_path = src_path.with_suffix(".spec.ts")
+        jobs = []
+        for t in targets[:parallel]:
+            src_path = Path(t.path)
+            spec_path = src_path.with_suffix(".spec.ts")
 
-        print(
-            f"Target: {t.path} | lines {t.lh}/{t.lf} ({t.line_pct:.2f}%) | "
-            f"branches {t.brh}/{t.brf} ({t.branch_pct:.2f}%)"
-        )
+            print(
+                f"Target: {t.path} | lines {t.lh}/{t.lf} ({t.line_pct:.2f}%) | "
+                f"branches {t.brh}/{t.brf} ({t.branch_pct:.2f}%)"
+            )
 
-        if not src_path.exists():
-            print(f"Skip: source not found on disk: {src_path}")
-            # Remove it from consideration by continuing (next iteration re-evaluates)
-            continue
+            if not src_path.exists():
+                print(f"Skip: source not found on disk: {src_path}")
+                # Remove it from consideration by continuing (next iteration re-evaluates)
+                continue
 
-        generate_or_update_spec(
-            model=args.model,
-            src_path=src_path,
-            spec_path=spec_path,
-            min_pct=min_pct,
-            line_pct=t.line_pct,
-            branch_pct=t.branch_pct,
-        )
-        print(f"Updated: {spec_path}")
+            jobs.append(
+                (
+                    t.path,
+                    spec_path,
+                    generate_or_update_spec(
+                        model=args.model,
+                        src_path=src_path,
+                        spec_path=spec_path,
+                        min_pct=min_pct,
+                        line_pct=t.line_pct,
+                        branch_pct=t.branch_pct,
+                        llm_slots=llm_slots,
+                        validate_lock=validate_lock,
+                        llm_cache=llm_cache,
+                        coverage_dir=DELTA_COVERAGE_DIR if incremental else None,
+                    ),
+                )
+            )
+
+        # Let every job finish (and restore its spec on failure) before surfacing errors.
+        results = await asyncio.gather(*(job for _, _, job in jobs), return_exceptions=True)
+        updated: Dict[str, Path] = {}
+        deltas: Dict[str, Optional[Dict[str, CoverageEntry]]] = {}
+        for (path, spec_path, _), result in zip(jobs, results):
+            if not isinstance(result, BaseException):
+                print(f"Updated: {spec_path}")
+                updated[path] = spec_path
+                deltas[path] = result
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        if updated:
+            cov_is_full_and_current = False
+            last_write_ns = max(p.stat().st_mtime_ns for p in updated.values())
+
+        if incremental and updated:
+            # Only the updated sources' records can have changed; everything else stays valid.
+            # Each validation run only sees its own spec, so a replaced record is a lower bound
+            # (other specs covering the file are not counted) that the next full run corrects.
+            for path in updated:
+                delta = deltas[path]
+                if delta is None or path not in delta:
+                    print(f"No incremental coverage for {path}, falling back to a full run")
+                    cov = None
+                    break
+                cov[path] = delta[path]
+                from_delta.add(path)
 
     # Final check after exhausting iterations
     try:
-        run_ng_test_with_coverage()
-        lcov = find_lcov()
-        cov = parse_lcov(lcov)
+        # Reuse the last full run when no spec has been written since (and sources are unchanged).
+        if cov is None or not cov_is_full_and_current or source_signature() != src_sig:
+            cov = full_coverage()
         targets = undercovered_files(cov, min_pct)
         if not targets:
             print(f"OK: all files meet >= {min_pct:.0f}% lines and branches")
@@ -376,4 +966,4 @@ def main() -> int:
 
 
 if __name__ == "__main__":
-    raise SystemExit(main())
\ No newline at end of file
+    raise SystemExit(asyncio.run(main()))
\ No newline at end of file